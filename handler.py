@@ -1,17 +1,71 @@
 import os
+import sys
 import json
 import uuid
 import base64
 import logging
 import time
-import urllib.request
-import urllib.parse
+import socket
+import requests
+import urllib3
 import websocket
 import runpod
 import binascii
 import tempfile
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from io import BytesIO
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import pybase64
+
+    def _b64decode_strict(data):
+        return pybase64.b64decode(data, validate=True)
+except ImportError:
+    if sys.version_info >= (3, 11):
+        # один проход с проверкой алфавита вместо regex + decode в base64.b64decode
+        def _b64decode_strict(data):
+            return binascii.a2b_base64(data, strict_mode=True)
+    else:
+        def _b64decode_strict(data):
+            return base64.b64decode(data, validate=True)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# cv2 и turbojpeg работают с numpy-массивами — без numpy оба пути выключены
+cv2 = None
+_turbojpeg = None
+
+if np is not None:
+    try:
+        import cv2
+    except ImportError:
+        pass
+
+    try:
+        from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_444
+
+        _turbojpeg = TurboJPEG()
+    except (ImportError, OSError, RuntimeError):
+        pass
+
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
 
 # ================== GCS CREDENTIALS BOOTSTRAP ==================
 
@@ -51,16 +105,17 @@ from google.cloud import storage
 GCS_BUCKET = os.getenv("GCS_BUCKET", "generations-reserve")
 
 _storage_client = storage.Client()
+_bucket = _storage_client.bucket(GCS_BUCKET)
 
 def upload_to_gcs(image_bytes, content_type="image/jpeg"):
-    bucket = _storage_client.bucket(GCS_BUCKET)
-
     filename = f"results/{uuid.uuid4().hex}.jpg"
-    blob = bucket.blob(filename)
+    blob = _bucket.blob(filename)
 
-    blob.upload_from_string(
-        image_bytes,
-        content_type=content_type
+    blob.upload_from_file(
+        BytesIO(image_bytes),
+        size=len(image_bytes),
+        content_type=content_type,
+        checksum=None
     )
 
     return f"https://storage.googleapis.com/{GCS_BUCKET}/{filename}"
@@ -77,6 +132,7 @@ logger.info("=" * 80)
 logger.info("🚀🚀🚀  STARTING HANDLER")
 logger.info(f"🔥🔥🔥  DEV  = >>> {DEV} <<<")
 logger.info(f"🔥🔥🔥  TEST = >>> {TEST} <<<")
+logger.info(f"🖼️  JPEG encoder = {'libjpeg-turbo' if _turbojpeg is not None else 'PIL'}")
 logger.info("=" * 80)
 
 # ================== GLOBALS ==================
@@ -84,7 +140,40 @@ logger.info("=" * 80)
 SERVER_ADDRESS = os.getenv("SERVER_ADDRESS", "127.0.0.1")
 CLIENT_ID = str(uuid.uuid4())
 
+COMFY_HTTP_URL = f"http://{SERVER_ADDRESS}:8188"
+COMFY_PROMPT_URL = f"{COMFY_HTTP_URL}/prompt"
+COMFY_HISTORY_URL = f"{COMFY_HTTP_URL}/history/"
+COMFY_VIEW_URL = f"{COMFY_HTTP_URL}/view"
+COMFY_WS_URL = f"ws://{SERVER_ADDRESS}:8188/ws?clientId={CLIENT_ID}"
+
+# {"client_id": ..., "prompt": <workflow>} — константная часть сериализуется один раз
+PROMPT_ENVELOPE_PREFIX = b'{"client_id":' + _json_dumps(CLIENT_ID) + b',"prompt":'
+PROMPT_ENVELOPE_SUFFIX = b"}"
+
 COMFY_INPUT_DIR = "/workspace/ComfyUI/input"
+INPUT_IMAGE_PATH = os.path.join(COMFY_INPUT_DIR, "input_image.jpg")
+INPUT_DRAFT_SIZE = (1024, 1024)
+COMFY_OUTPUT_DIR = os.getenv("COMFY_OUTPUT_DIR", "/ComfyUI/output")
+COMFY_IS_LOCAL = SERVER_ADDRESS in ("127.0.0.1", "localhost", "::1")
+
+# keep-alive сессия для ComfyUI: без нового TCP-соединения на каждый вызов
+_session = requests.Session()
+_session.mount(
+    "http://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=2, backoff_factor=0.1)
+    )
+)
+
+# пользовательские image_url — отдельный пул: без cookie jar, .netrc и env-прокси,
+# чтобы между задачами разных клиентов ничего не протекало
+_download_pool = urllib3.PoolManager(
+    num_pools=4,
+    maxsize=4,
+    retries=Retry(connect=2, read=2, redirect=10, backoff_factor=0.1)
+)
 
 DEFAULT_WORKFLOW_PATH = os.path.join(
     os.path.dirname(__file__),
@@ -93,58 +182,196 @@ DEFAULT_WORKFLOW_PATH = os.path.join(
 
 # ================== COMFY HELPERS ==================
 
+_comfy_ready = False
+
 def wait_for_comfyui(timeout=180):
-    url = f"http://{SERVER_ADDRESS}:8188/"
-    for _ in range(timeout):
+    global _comfy_ready
+    if _comfy_ready:
+        return
+
+    url = f"{COMFY_HTTP_URL}/"
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+
+    # сначала дешёвый TCP-probe с экспоненциальным backoff,
+    # HTTP-запрос только когда порт уже принимает соединения
+    while time.monotonic() < deadline:
         try:
-            urllib.request.urlopen(url, timeout=3)
+            socket.create_connection((SERVER_ADDRESS, 8188), timeout=0.25).close()
+            _session.get(url, timeout=3).raise_for_status()
             logger.info("✅ ComfyUI HTTP ready")
+            _comfy_ready = True
             return
         except Exception:
-            time.sleep(1)
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
     raise RuntimeError("ComfyUI is not reachable.")
 
 # ================== WORKFLOW ==================
 
+IMAGE_PATH_PLACEHOLDER = f"__image_path_{uuid.uuid4().hex}__"
+
+def _split_workflow(workflow):
+    """
+    Сериализует workflow с плейсхолдером вместо пути к картинке в LoadImage
+    (нода "1") и возвращает шаблон (head, tail) вокруг него.
+    Исходный workflow (в т.ч. job["input"]) не изменяется.
+    """
+    node = workflow["1"]
+    workflow = {
+        **workflow,
+        "1": {**node, "inputs": {**node["inputs"], "image": IMAGE_PATH_PLACEHOLDER}},
+    }
+    head, tail = _json_dumps(workflow).split(_json_dumps(IMAGE_PATH_PLACEHOLDER), 1)
+    return head, tail
+
+def compile_workflow(raw_json):
+    return _split_workflow(_json_loads(raw_json))
+
+def render_workflow(template, image_path):
+    head, tail = template
+    return head + _json_dumps(image_path) + tail
+
+@functools.lru_cache(maxsize=None)
+def _default_workflow_template():
+    with open(DEFAULT_WORKFLOW_PATH, "rb") as f:
+        return compile_workflow(f.read())
+
 def load_workflow(client_workflow=None):
     if client_workflow:
         logger.info("🧩 Using client-provided workflow")
-        return client_workflow
+        return _split_workflow(client_workflow)
 
     logger.info("🧩 Using default workflow.json")
     try:
-        with open(DEFAULT_WORKFLOW_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return _default_workflow_template()
     except Exception as e:
         raise RuntimeError("Failed to load default workflow.json.") from e
 
 # ================== IMAGE LOADING ==================
 
+DATA_URL_PREFIX_LIMIT = 256
+
+def _strip_data_url(payload):
+    # префикс "data:image/...;base64," всегда короткий — не сканируем весь payload
+    comma = payload.find(b",", 0, DATA_URL_PREFIX_LIMIT)
+    view = memoryview(payload)
+    return view[comma + 1:] if comma != -1 else view
+
 def load_image_bytes(image_url=None, image_base64=None):
     if image_url:
         logger.info(f"🌐 Downloading image from URL: {image_url}")
         try:
-            with urllib.request.urlopen(image_url, timeout=15) as response:
-                return response.read()
+            # read() читает тело одним буфером, без списка чанков и join
+            resp = _download_pool.request(
+                "GET",
+                image_url,
+                timeout=15,
+                preload_content=False
+            )
+            try:
+                if resp.status >= 400:
+                    raise RuntimeError(f"HTTP {resp.status}")
+                return resp.read(decode_content=True)
+            finally:
+                resp.release_conn()
         except Exception as e:
             raise RuntimeError("Failed to download image from 'image_url'.") from e
 
     if image_base64:
         try:
-            if "," in image_base64:
-                image_base64 = image_base64.split(",", 1)[1]
-            return base64.b64decode(image_base64, validate=True)
+            if isinstance(image_base64, str):
+                image_base64 = image_base64.encode("ascii")
+            return _b64decode_strict(_strip_data_url(image_base64))
         except (binascii.Error, ValueError) as e:
             raise RuntimeError("Invalid 'image_base64'.") from e
 
     raise RuntimeError("No image source provided.")
 
-def save_image_bytes_as_jpeg(raw_bytes):
-    os.makedirs(COMFY_INPUT_DIR, exist_ok=True)
-    out_path = os.path.join(COMFY_INPUT_DIR, "input_image.jpg")
+JPEG_SOF_MARKERS = (0xC0, 0xC1, 0xC2)
+
+def _plain_rgb_jpeg_size(raw_bytes):
+    """
+    Возвращает (width, height), если raw_bytes — обычный 8-битный
+    трёхкомпонентный JPEG, который можно отдать ComfyUI без перекодирования.
+    Иначе None.
+    """
+    # SOI в начале и EOI в конце — обрезанный upload уходит в PIL-путь и там падает
+    if raw_bytes[:3] != b"\xff\xd8\xff" or raw_bytes[-2:] != b"\xff\xd9":
+        return None
+
+    pos = 2
+    end = len(raw_bytes)
+    while pos + 4 <= end:
+        if raw_bytes[pos] != 0xFF:
+            return None
+        marker = raw_bytes[pos + 1]
+
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            pos += 2
+            continue
+
+        seg_len = int.from_bytes(raw_bytes[pos + 2:pos + 4], "big")
+
+        # ComfyUI применяет EXIF orientation, а PIL-путь её отбрасывает
+        if marker == 0xE1 and raw_bytes[pos + 4:pos + 10] == b"Exif\x00\x00":
+            return None
+
+        if marker in JPEG_SOF_MARKERS:
+            if pos + 10 > end:
+                return None
+            precision = raw_bytes[pos + 4]
+            height = int.from_bytes(raw_bytes[pos + 5:pos + 7], "big")
+            width = int.from_bytes(raw_bytes[pos + 7:pos + 9], "big")
+            components = raw_bytes[pos + 9]
+            if precision != 8 or components != 3 or not width or not height:
+                return None
+            return width, height
+
+        # lossless / arithmetic SOF или SOS раньше SOF
+        if 0xC3 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return None
+        if marker == 0xDA:
+            return None
+
+        pos += 2 + seg_len
+
+    return None
+
+def _write_file(path, data):
+    # без fsync: ComfyUI читает файл сразу же, из page cache
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        mv = memoryview(data)
+        written = 0
+        while written < len(mv):
+            written += os.write(fd, mv[written:])
+    finally:
+        os.close(fd)
+
+@functools.lru_cache(maxsize=None)
+def _ensure_dir(path):
+    os.makedirs(path, exist_ok=True)
+
+def save_image_bytes_as_jpeg(raw_bytes, draft_size=None):
+    _ensure_dir(COMFY_INPUT_DIR)
+    out_path = INPUT_IMAGE_PATH
+
+    size = _plain_rgb_jpeg_size(raw_bytes)
+    if size is not None:
+        _write_file(out_path, raw_bytes)
+        return out_path, size
 
     try:
         img = Image.open(BytesIO(raw_bytes))
+        size = img.size
+        # для JPEG libjpeg сразу декодирует в уменьшенном масштабе (1/2, 1/4, 1/8),
+        # не меньше draft_size; для остальных форматов draft ничего не делает
+        if draft_size:
+            img.draft("RGB", draft_size)
         img.load()
     except Exception as e:
         raise RuntimeError("Invalid image file.") from e
@@ -152,66 +379,157 @@ def save_image_bytes_as_jpeg(raw_bytes):
     if img.mode != "RGB":
         img = img.convert("RGB")
 
-    img.save(out_path, format="JPEG", quality=100, subsampling=0)
-    return out_path, img.size
+    img.save(
+        out_path,
+        format="JPEG",
+        quality=90,
+        subsampling=2,
+        progressive=False,
+        optimize=False
+    )
+    return out_path, size
 
 # ================== COMFY API ==================
 
 def queue_prompt(prompt):
-    url = f"http://{SERVER_ADDRESS}:8188/prompt"
-    payload = {"prompt": prompt, "client_id": CLIENT_ID}
-    data = json.dumps(payload).encode("utf-8")
+    if not isinstance(prompt, bytes):
+        prompt = _json_dumps(prompt)
+    data = PROMPT_ENVELOPE_PREFIX + prompt + PROMPT_ENVELOPE_SUFFIX
 
-    req = urllib.request.Request(
-        url,
+    resp = _session.post(
+        COMFY_PROMPT_URL,
         data=data,
         headers={"Content-Type": "application/json"}
     )
-
-    with urllib.request.urlopen(req) as resp:
-        return json.loads(resp.read())
+    resp.raise_for_status()
+    return _json_loads(resp.content)
 
 def get_history(prompt_id):
-    url = f"http://{SERVER_ADDRESS}:8188/history/{prompt_id}"
-    with urllib.request.urlopen(url) as response:
-        return json.loads(response.read())
+    resp = _session.get(COMFY_HISTORY_URL + prompt_id)
+    resp.raise_for_status()
+    return _json_loads(resp.content)
 
 def get_image(filename, subfolder, folder_type):
-    url = f"http://{SERVER_ADDRESS}:8188/view"
+    # ComfyUI на этой же машине — читаем результат прямо с диска, без HTTP
+    if COMFY_IS_LOCAL and folder_type == "output":
+        try:
+            with open(os.path.join(COMFY_OUTPUT_DIR, subfolder, filename), "rb") as f:
+                return f.read()
+        except OSError:
+            pass
+
     params = {
         "filename": filename,
         "subfolder": subfolder,
         "type": folder_type,
     }
-    query = urllib.parse.urlencode(params)
-    with urllib.request.urlopen(f"{url}?{query}") as response:
-        return response.read()
+    resp = _session.get(COMFY_VIEW_URL, params=params)
+    resp.raise_for_status()
+    return resp.content
+
+_ws = None
+_ws_lock = threading.Lock()
+
+def _connect_ws():
+    ws = websocket.WebSocket(skip_utf8_validation=True)
+    ws.connect(COMFY_WS_URL)
+    logger.info("🔌 WebSocket connected")
+    return ws
+
+def _drop_ws():
+    global _ws
+    if _ws is not None:
+        try:
+            _ws.close()
+        except Exception:
+            pass
+    _ws = None
+
+def _ensure_ws():
+    """
+    WebSocket к ComfyUI живёт между задачами; переподключаемся,
+    только если соединение закрыто или не проходит ping.
+    """
+    global _ws
+    if _ws is not None and _ws.connected:
+        try:
+            _ws.ping()
+            return _ws
+        except Exception:
+            _drop_ws()
+
+    _ws = _connect_ws()
+    return _ws
+
+# фоновое ожидание готовности ComfyUI, пока handler готовит входную картинку
+_io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="comfy-io")
+
+# обрыв WebSocket; HTTP-ошибки (requests.RequestException) сюда не входят
+WS_ERRORS = (websocket.WebSocketException, ConnectionError, socket.timeout)
 
-def get_images(ws, workflow):
+def wait_for_prompt(ws, prompt_id):
+    recv = ws.recv
+    while True:
+        msg = recv()
+        # бинарные превью и progress/status-события не парсим
+        if not isinstance(msg, str) or '"executing"' not in msg:
+            continue
+        data = _json_loads(msg)
+        if data.get("type") != "executing":
+            continue
+        event = data["data"]
+        if event["node"] is None and event.get("prompt_id") == prompt_id:
+            return
+
+def get_images(ws, workflow, limit=None):
     prompt_id = queue_prompt(workflow)["prompt_id"]
     logger.info(f"🚀 prompt_id = {prompt_id}")
 
-    while True:
-        msg = ws.recv()
-        if isinstance(msg, str):
-            data = json.loads(msg)
-            if data["type"] == "executing":
-                if data["data"]["node"] is None and data["data"]["prompt_id"] == prompt_id:
-                    break
+    try:
+        wait_for_prompt(ws, prompt_id)
+    except WS_ERRORS:
+        # промпт уже в очереди — не отправляем повторно, ждём тот же prompt_id;
+        # если он успел завершиться, пока сокета не было, он уже есть в history
+        logger.warning("♻️ WebSocket dropped, reconnecting and waiting on the same prompt")
+        _drop_ws()
+        ws = _ensure_ws()
+        if prompt_id not in get_history(prompt_id):
+            wait_for_prompt(ws, prompt_id)
 
     history = get_history(prompt_id)[prompt_id]
-    images = []
+    jobs = [
+        (img["filename"], img["subfolder"], img["type"])
+        for node_output in history["outputs"].values()
+        for img in node_output.get("images", [])
+    ][:limit]
 
-    for node_output in history["outputs"].values():
-        if "images" in node_output:
-            for img in node_output["images"]:
-                raw = get_image(img["filename"], img["subfolder"], img["type"])
-                images.append(raw)
-
-    return images
+    return [get_image(*args) for args in jobs]
 
 # ================== IMAGE POSTPROCESS ==================
 
+_tls = threading.local()
+
+def _get_scratch_io():
+    buf = getattr(_tls, "buf", None)
+    if buf is None:
+        buf = _tls.buf = BytesIO()
+    buf.seek(0)
+    return buf
+
+def _resize_rgb(img, size):
+    shrink = size[0] <= img.width and size[1] <= img.height
+    grow = size[0] >= img.width and size[1] >= img.height
+
+    # INTER_AREA на уменьшение (антиалиасинг как у PIL LANCZOS), LANCZOS4 на увеличение;
+    # если одна ось уменьшается, а другая растёт — остаёмся на PIL
+    if cv2 is None or not (shrink or grow):
+        return img.resize(size, Image.LANCZOS)
+
+    interpolation = cv2.INTER_AREA if shrink else cv2.INTER_LANCZOS4
+    return Image.fromarray(
+        cv2.resize(np.asarray(img), size, interpolation=interpolation)
+    )
+
 def process_output_image(
     raw_bytes,
     target_size,
@@ -224,9 +542,19 @@ def process_output_image(
         img = img.convert("RGB")
 
     if original_size and img.size != target_size:
-        img = img.resize(target_size, Image.LANCZOS)
-
-    buf = BytesIO()
+        img = _resize_rgb(img, target_size)
+
+    if _turbojpeg is not None:
+        return _turbojpeg.encode(
+            np.asarray(img),
+            quality=max(quality, 1),
+            pixel_format=TJPF_RGB,
+            jpeg_subsample=TJSAMP_444
+        )
+
+    # буфер переиспользуется между задачами; truncate() не вызываем,
+    # чтобы BytesIO не отдавал уже выделенную память
+    buf = _get_scratch_io()
     img.save(
         buf,
         format="JPEG",
@@ -234,7 +562,9 @@ def process_output_image(
         subsampling=0,
         optimize=True
     )
-    return buf.getvalue()
+    size = buf.tell()
+    buf.seek(0)
+    return buf.read(size)
 
 # ================== HANDLER ==================
 
@@ -253,21 +583,23 @@ def handler(job):
     if not image_url and not image_base64:
         return {"error": "Image source missing."}
 
-    workflow = load_workflow(client_workflow)
-    raw_bytes = load_image_bytes(image_url=image_url, image_base64=image_base64)
-    image_path, input_size = save_image_bytes_as_jpeg(raw_bytes)
+    # ожидание ComfyUI идёт параллельно с загрузкой и подготовкой картинки;
+    # на тёплом воркере флаг уже выставлен — поток не задействуем
+    comfy_ready = None if _comfy_ready else _io_pool.submit(wait_for_comfyui)
 
-    workflow["1"]["inputs"]["image"] = image_path
+    workflow_template = load_workflow(client_workflow)
+    raw_bytes = load_image_bytes(image_url=image_url, image_base64=image_base64)
+    # дефолтный workflow всё равно масштабирует вход через FluxKontextImageScale
+    draft_size = None if client_workflow else INPUT_DRAFT_SIZE
+    image_path, input_size = save_image_bytes_as_jpeg(raw_bytes, draft_size=draft_size)
 
-    wait_for_comfyui()
+    workflow = render_workflow(workflow_template, image_path)
 
-    ws = websocket.WebSocket()
-    ws.connect(f"ws://{SERVER_ADDRESS}:8188/ws?clientId={CLIENT_ID}")
+    if comfy_ready is not None:
+        comfy_ready.result()
 
-    try:
-        images = get_images(ws, workflow)
-    finally:
-        ws.close()
+    with _ws_lock:
+        images = get_images(_ensure_ws(), workflow, limit=1)
 
     if not images:
         return {"error": "No images generated."}